@@ -0,0 +1,61 @@
+"""
+Measures how much importing this plugin adds to the startup of a pretix worker.
+
+Runs ``django.setup()`` in a fresh interpreter with ``-X importtime`` and sums up the cumulative import time of
+all top-level ``pretix_wirecard`` imports, i.e. the plugin's own modules plus everything that is loaded for the
+first time because of them.
+
+Usage::
+
+    DJANGO_SETTINGS_MODULE=pretix.testutils.settings python benchmarks/import_time.py [--runs 5]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure():
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'pretix.testutils.settings')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import django; django.setup()'],
+        env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True
+    )
+    total = 0
+    modules = 0
+    plugin_depth = None
+    # importtime prints children before their parent, so we walk the output backwards to see parents first
+    for line in reversed(proc.stderr.splitlines()):
+        m = LINE.match(line)
+        if not m:
+            continue
+        cumulative, depth, name = int(m.group(2)), len(m.group(3)), m.group(4)
+        if plugin_depth is not None and depth > plugin_depth:
+            modules += 1
+            continue
+        plugin_depth = None
+        if name.startswith('pretix_wirecard'):
+            total += cumulative
+            modules += 1
+            plugin_depth = depth
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    times = [t for t, m in results]
+    print('modules imported by the plugin: {}'.format(results[-1][1]))
+    print('import time (us): median {:.0f}, min {}, max {}'.format(statistics.median(times), min(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
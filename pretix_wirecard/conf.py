@@ -0,0 +1,40 @@
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+INIT_URL = 'https://checkout.wirecard.com/page/init.php'
+TOOLKIT_URL = 'https://checkout.wirecard.com/page/toolkit.php'
+
+
+def _get(name, default):
+    config = getattr(settings, 'CONFIG_FILE', None)
+    if config is None:
+        return default
+    return config.get('wirecard', name, fallback=default)
+
+
+def init_url() -> str:
+    return _get('init_url', INIT_URL)
+
+
+def toolkit_url() -> str:
+    return _get('toolkit_url', TOOLKIT_URL)
+
+
+def init_host() -> str:
+    return urlparse(init_url()).netloc
+
+
+def sweep_created_after() -> int:
+    """
+    Hours after which a created payment that Wirecard did not report as successful or pending is canceled.
+    """
+    return int(_get('sweep_created_after', 24))
+
+
+def sweep_pending_after() -> int:
+    """
+    Hours after which a payment that Wirecard reported as pending, but never confirmed, is marked as failed. This
+    is measured from the creation of the payment.
+    """
+    return int(_get('sweep_pending_after', 24 * 30))
@@ -0,0 +1,117 @@
+import csv
+import json
+import tempfile
+from collections import OrderedDict
+
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+from pretix.base.exporter import BaseExporter
+from pretix.base.models import OrderPayment, OrderRefund
+
+CHUNK_SIZE = 2000
+
+COLUMNS = (
+    'type', 'order', 'id', 'provider', 'state', 'amount', 'currency', 'created', 'date',
+    'orderNumber', 'paymentType', 'financialInstitution', 'paymentState',
+)
+
+
+class WirecardTransactionExporter(BaseExporter):
+    identifier = 'wirecard_transactions'
+    verbose_name = _('Wirecard transactions')
+
+    @property
+    def export_form_fields(self):
+        return OrderedDict(
+            [
+                ('format',
+                 forms.ChoiceField(
+                     label=_('Format'),
+                     choices=(
+                         ('csv', _('CSV (comma-separated)')),
+                         ('jsonl', _('JSON lines')),
+                     ),
+                 )),
+            ]
+        )
+
+    def _payment_rows(self):
+        qs = OrderPayment.objects.filter(
+            order__event=self.event, provider__startswith='wirecard'
+        ).order_by('pk').values_list(
+            'order__code', 'local_id', 'provider', 'state', 'amount', 'created', 'payment_date', 'info'
+        )
+        # values_list() + iterator() uses a server-side cursor where the database supports it and never
+        # instantiates model objects, so memory use stays constant regardless of the number of payments.
+        for code, local_id, provider, state, amount, created, date, info in qs.iterator(chunk_size=CHUNK_SIZE):
+            yield self._row('payment', code, local_id, provider, state, amount, created, date, info)
+
+    def _refund_rows(self):
+        qs = OrderRefund.objects.filter(
+            order__event=self.event, provider__startswith='wirecard'
+        ).order_by('pk').values_list(
+            'order__code', 'local_id', 'provider', 'state', 'amount', 'created', 'execution_date', 'info',
+            'payment__info'
+        )
+        for code, local_id, provider, state, amount, created, date, info, pinfo in qs.iterator(chunk_size=CHUNK_SIZE):
+            yield self._row('refund', code, local_id, provider, state, amount, created, date, info, pinfo)
+
+    def _row(self, kind, code, local_id, provider, state, amount, created, date, info, payment_info=None):
+        d = _parse_info(info)
+        if kind == 'refund':
+            # Only identify the Wirecard transaction through the payment, the state of the payment says nothing
+            # about the state of the refund
+            p = _parse_info(payment_info)
+            d = {k: d.get(k) or p.get(k, '') for k in ('orderNumber', 'paymentType', 'financialInstitution')}
+        return OrderedDict((
+            ('type', kind),
+            ('order', code),
+            ('id', '{}-{}-{}'.format(code, 'P' if kind == 'payment' else 'R', local_id)),
+            ('provider', provider),
+            ('state', state),
+            ('amount', str(amount)),
+            ('currency', self.event.currency),
+            ('created', created.isoformat() if created else ''),
+            ('date', date.isoformat() if date else ''),
+            ('orderNumber', d.get('orderNumber', '')),
+            ('paymentType', d.get('paymentType', '')),
+            ('financialInstitution', d.get('financialInstitution', '')),
+            ('paymentState', d.get('paymentState', '')),
+        ))
+
+    def _rows(self):
+        yield from self._payment_rows()
+        yield from self._refund_rows()
+
+    def render(self, form_data: dict):
+        fmt = form_data.get('format', 'csv')
+        # Rows are written one by one into a temporary file on disk, so we never hold both the query results
+        # and the rendered output in memory.
+        with tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='') as f:
+            if fmt == 'jsonl':
+                for row in self._rows():
+                    f.write(json.dumps(row))
+                    f.write('\n')
+            else:
+                writer = csv.DictWriter(f, fieldnames=COLUMNS, quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+                writer.writeheader()
+                for row in self._rows():
+                    writer.writerow(row)
+            f.flush()
+            f.seek(0)
+            data = f.buffer.read()
+
+        if fmt == 'jsonl':
+            return '{}_wirecard.jsonl'.format(self.event.slug), 'application/x-ndjson', data
+        return '{}_wirecard.csv'.format(self.event.slug), 'text/csv', data
+
+
+def _parse_info(info):
+    if not info:
+        return {}
+    try:
+        d = json.loads(info)
+    except ValueError:
+        return {}
+    return d if isinstance(d, dict) else {}
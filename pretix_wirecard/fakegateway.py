@@ -0,0 +1,285 @@
+"""
+A fake Wirecard Checkout Page for load testing pretix without talking to Wirecard.
+
+The server accepts the form posts the plugin sends to ``init.php``, verifies their fingerprint, sends signed
+confirmation callbacks to the ``confirmUrl`` of the payment and answers the customer's browser with a form that
+posts a signed result to the matching success, failure, cancel or pending URL, just like Wirecard does.
+Callbacks are sent by a pool of threads sharing a common rate limit. It also answers refund requests sent to
+``toolkit.php``.
+
+To use it, start the server and point pretix to it in ``pretix.cfg``::
+
+    [wirecard]
+    init_url=http://localhost:8089/page/init.php
+    toolkit_url=http://localhost:8089/page/toolkit.php
+
+    python -m pretix_wirecard.fakegateway --secret <secret> --toolkit-password <password> \\
+        --scenarios SUCCESS=90,PENDING=4,FAILURE=3,CANCEL=2,DUPLICATE=1 --rate 50
+
+Only use this for testing. It does not implement Wirecard's full API and never moves any money.
+"""
+import argparse
+import hashlib
+import hmac
+import html
+import itertools
+import logging
+import queue
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlencode
+from urllib.request import urlopen
+
+logger = logging.getLogger('pretix_wirecard.fakegateway')
+
+SCENARIOS = ('SUCCESS', 'PENDING', 'FAILURE', 'CANCEL', 'DUPLICATE')
+REFUND_ORDER = ['customerId', 'shopId', 'toolkitPassword', 'secret', 'command', 'language', 'orderNumber', 'amount',
+                'currency']
+
+
+def fingerprint(secret: str, params: dict, order: list) -> str:
+    payload = ''.join(secret if k == 'secret' else params[k] for k in order)
+    return hmac.new(secret.encode(), payload.encode(), hashlib.sha512).hexdigest().upper()
+
+
+class RateLimiter:
+    """
+    Hands out evenly spaced time slots to any number of threads. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_scenarios(value: str) -> dict:
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip().upper()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError('Unknown scenario {}'.format(name))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Gateway:
+    def __init__(self, secret, toolkit_password, scenarios, rate, pending_delay, refund_failure_rate):
+        self.secret = secret
+        self.toolkit_password = toolkit_password
+        self.scenarios = scenarios
+        self.limiter = RateLimiter(rate)
+        self.pending_delay = pending_delay
+        self.refund_failure_rate = refund_failure_rate
+        self.order_numbers = itertools.count(10000000)
+        self.seen_references = set()
+        self.lock = threading.Lock()
+        self.callbacks = queue.Queue()
+        self.delayed = 0
+        self.stats = {'init': 0, 'rejected': 0, 'callbacks': 0, 'callback_errors': 0, 'refunds': 0}
+
+    def sign_response(self, params: dict) -> dict:
+        params = dict(params)
+        keys = list(params.keys()) + ['secret', 'responseFingerprintOrder']
+        params['responseFingerprintOrder'] = ','.join(keys)
+        params['responseFingerprint'] = fingerprint(self.secret, params, keys)
+        return params
+
+    def verify_request(self, params: dict, order: list=None) -> bool:
+        order = order or params.get('requestFingerprintOrder', '').split(',')
+        if 'secret' not in order or 'requestFingerprint' not in params:
+            return False
+        try:
+            fp = fingerprint(self.secret, params, order)
+        except KeyError:
+            return False
+        return hmac.compare_digest(fp, params['requestFingerprint'].upper())
+
+    def pick_scenario(self) -> str:
+        names = list(self.scenarios.keys())
+        return random.choices(names, weights=[self.scenarios[n] for n in names])[0]
+
+    def result(self, params: dict, order_number: str, state: str) -> dict:
+        res = {
+            'paymentState': state,
+            'paymentType': params.get('paymentType', 'SELECT').replace('SELECT', 'CCARD'),
+            'amount': params.get('amount', ''),
+            'currency': params.get('currency', ''),
+            'language': params.get('language', ''),
+        }
+        if state in ('SUCCESS', 'PENDING'):
+            res['orderNumber'] = order_number
+            res['financialInstitution'] = 'FAKE'
+        if state == 'FAILURE':
+            res['message'] = 'Simulated failure'
+        # Wirecard sends custom parameters back to us
+        res.update({k: v for k, v in params.items() if k.startswith('pretix_')})
+        return self.sign_response(res)
+
+    def init(self, params: dict):
+        """
+        Returns the URL and the parameters the customer's browser should be sent to, or ``None`` if the request
+        is rejected.
+        """
+        with self.lock:
+            self.stats['init'] += 1
+            if not self.verify_request(params):
+                self.stats['rejected'] += 1
+                return None
+            if params.get('duplicateRequestCheck') == 'yes':
+                if params.get('orderReference') in self.seen_references:
+                    self.stats['rejected'] += 1
+                    return None
+                self.seen_references.add(params.get('orderReference'))
+            order_number = str(next(self.order_numbers))
+
+        scenario = self.pick_scenario()
+        if scenario == 'DUPLICATE':
+            res = self.result(params, order_number, 'SUCCESS')
+            self.callbacks.put((0, params['confirmUrl'], res))
+            self.callbacks.put((0, params['confirmUrl'], res))
+            return params['successUrl'], res
+        elif scenario == 'PENDING':
+            # Like Wirecard, tell the shop about the pending state server-to-server, send the customer to the
+            # pendingUrl and confirm the payment later
+            res = self.result(params, order_number, 'PENDING')
+            self.callbacks.put((0, params['confirmUrl'], res))
+            self.callbacks.put((self.pending_delay, params['confirmUrl'], self.result(params, order_number, 'SUCCESS')))
+            return params['pendingUrl'], res
+        res = self.result(params, order_number, scenario)
+        self.callbacks.put((0, params['confirmUrl'], res))
+        return {
+            'SUCCESS': params['successUrl'],
+            'FAILURE': params['failureUrl'],
+            'CANCEL': params['cancelUrl'],
+        }[scenario], res
+
+    def refund(self, params: dict) -> dict:
+        with self.lock:
+            self.stats['refunds'] += 1
+        if not self.verify_request(params, REFUND_ORDER) or params.get('toolkitPassword') != self.toolkit_password:
+            return {'status': '1', 'message': 'Invalid request fingerprint or toolkit password.'}
+        if random.random() < self.refund_failure_rate:
+            return {'status': '1', 'message': 'Simulated refund failure.'}
+        return {'status': '0', 'creditNumber': str(next(self.order_numbers))}
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.stats, backlog=self.callbacks.qsize(), delayed=self.delayed)
+
+    def _requeue(self, url, params):
+        with self.lock:
+            self.delayed -= 1
+        self.callbacks.put((0, url, params))
+
+    def send_callbacks(self):
+        while True:
+            delay, url, params = self.callbacks.get()
+            if delay:
+                with self.lock:
+                    self.delayed += 1
+                threading.Timer(delay, self._requeue, args=(url, params)).start()
+                continue
+            self.limiter.wait()
+            try:
+                with urlopen(url, data=urlencode(params).encode(), timeout=30) as r:
+                    r.read()
+                with self.lock:
+                    self.stats['callbacks'] += 1
+            except Exception:
+                logger.exception('Callback to %s failed', url)
+                with self.lock:
+                    self.stats['callback_errors'] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    gateway = None
+
+    def _form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return dict(parse_qsl(self.rfile.read(length).decode()))
+
+    def _respond(self, status, body, content_type='text/html; charset=utf-8'):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._respond(200, urlencode(self.gateway.snapshot()), 'text/plain')
+        else:
+            self._respond(404, 'Not found')
+
+    def do_POST(self):
+        if self.path == '/page/init.php':
+            res = self.gateway.init(self._form())
+            if res is None:
+                self._respond(400, 'Invalid request.')
+                return
+            url, params = res
+            fields = ''.join(
+                "<input type='hidden' name='{}' value='{}'/>".format(html.escape(k), html.escape(v))
+                for k, v in params.items()
+            )
+            self._respond(200, "<html><body onload='document.forms[0].submit()'>"
+                               "<form action='{}' method='post'>{}<button>Continue</button></form>"
+                               "</body></html>".format(html.escape(url), fields))
+        elif self.path == '/page/toolkit.php':
+            self._respond(200, urlencode(self.gateway.refund(self._form())), 'application/x-www-form-urlencoded')
+        else:
+            self._respond(404, 'Not found')
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Wirecard Checkout Page for load testing')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--toolkit-password', default='')
+    parser.add_argument('--scenarios', type=parse_scenarios, default={'SUCCESS': 1},
+                        help='Weighted scenarios, e.g. SUCCESS=90,PENDING=5,FAILURE=3,CANCEL=1,DUPLICATE=1')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Maximum number of callbacks per second, 0 for unlimited')
+    parser.add_argument('--senders', type=int, default=32,
+                        help='Number of threads sending callbacks in parallel')
+    parser.add_argument('--pending-delay', type=float, default=5,
+                        help='Seconds until a PENDING payment is confirmed')
+    parser.add_argument('--refund-failure-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    Handler.gateway = Gateway(args.secret, args.toolkit_password, args.scenarios, args.rate, args.pending_delay,
+                              args.refund_failure_rate)
+    for i in range(args.senders):
+        threading.Thread(target=Handler.gateway.send_callbacks, daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    logger.info('Fake Wirecard gateway listening on http://%s:%d/', args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Cancel abandoned and fail stale pending Wirecard payments"
+
+    def add_arguments(self, parser):
+        from pretix_wirecard.conf import sweep_created_after, sweep_pending_after
+
+        parser.add_argument('--created-after', type=int, default=sweep_created_after(),
+                            help='Age in hours after which created payments are canceled')
+        parser.add_argument('--pending-after', type=int, default=sweep_pending_after(),
+                            help='Age in hours after which pending payments are marked as failed')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be changed')
+        parser.add_argument('--full', action='store_true',
+                            help='Also look at payments that have already been looked at in previous runs')
+
+    def handle(self, *args, **options):
+        from pretix.base.models import Event
+        from pretix_wirecard.sweeper import sweep_stale_payments
+
+        report = sweep_stale_payments(options['created_after'], options['pending_after'], options['dry_run'],
+                                      resume=not options['full'])
+        events = dict(Event.objects.filter(
+            pk__in=set().union(*(c.keys() for c in report.values()))
+        ).values_list('pk', 'slug'))
+        for sweep, counts in report.items():
+            self.stdout.write('{} {} payments: {}'.format(
+                'Stale' if options['dry_run'] else 'Swept', sweep, sum(counts.values())
+            ))
+            for event_id, count in counts.most_common():
+                self.stdout.write('    {}: {}'.format(events.get(event_id, event_id), count))
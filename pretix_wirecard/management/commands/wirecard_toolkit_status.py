@@ -0,0 +1,13 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Show the state of the circuit breaker for the Wirecard Toolkit endpoint"
+
+    def handle(self, *args, **options):
+        from pretix_wirecard.conf import toolkit_url
+        from pretix_wirecard.toolkit import CircuitBreaker
+
+        self.stdout.write(json.dumps(CircuitBreaker(toolkit_url()).status(), indent=4))
@@ -3,11 +3,11 @@ import hmac
 import json
 import logging
 from collections import OrderedDict
-from urllib.parse import parse_qs
 
-import requests
 from django import forms
 from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
 from django.http import HttpRequest
 from django.template.loader import get_template
 from django.utils.crypto import get_random_string
@@ -16,12 +16,14 @@ from typing import Union
 
 from pretix.base.models import Event, Order, OrderPayment, OrderRefund
 from pretix.base.payment import BasePaymentProvider, PaymentException
-from pretix.base.services.orders import mark_order_refunded
 from pretix.base.settings import SettingsSandbox
 from pretix.multidomain.urlreverse import eventreverse, build_absolute_uri
 
 logger = logging.getLogger(__name__)
 
+# Seconds for which the signed parameters of a payment are reused if the customer reloads the redirect page
+SIGNED_PARAMS_TTL = 120
+
 
 class WirecardSettingsHolder(BasePaymentProvider):
     identifier = 'wirecard'
@@ -187,6 +189,25 @@ class WirecardMethod(BasePaymentProvider):
         ).hexdigest().upper()
         return params
 
+    def signed_params_for_payment(self, payment: OrderPayment, request: HttpRequest) -> dict:
+        def key():
+            # Amount, state and credentials are part of the key, so any change to them invalidates the cache entry
+            return 'pretix_wirecard_params_{}'.format(hashlib.sha1('|'.join((
+                str(payment.pk), request.session.get('wirecard_nonce'), str(payment.amount), payment.state,
+                self.settings.get('customer_id') or '', self.settings.get('shop_id') or '', self.settings.get('secret') or '',
+            )).encode()).hexdigest())
+
+        if request.session.get('wirecard_nonce'):
+            params = cache.get(key())
+            if params is not None:
+                return params
+
+        # The nonce stays the same for the cached entry, so Wirecard sees the same orderReference and its
+        # duplicateRequestCheck behaves just like it did for a freshly computed request.
+        params = {k: str(v) for k, v in self.sign_parameters(self.params_for_payment(payment, request)).items()}
+        cache.set(key(), params, SIGNED_PARAMS_TTL)
+        return params
+
     def params_for_payment(self, payment, request):
         if not request.session.get('wirecard_nonce'):
             request.session['wirecard_nonce'] = get_random_string(length=12)
@@ -222,7 +243,7 @@ class WirecardMethod(BasePaymentProvider):
                 'payment': payment.pk,
                 'hash': hash,
             }).replace(':8000', ''),  # TODO: Remove
-            'pendingUrl': build_absolute_uri(self.event, 'plugins:pretix_wirecard:confirm', kwargs={
+            'pendingUrl': build_absolute_uri(self.event, 'plugins:pretix_wirecard:return', kwargs={
                 'order': payment.order.code,
                 'payment': payment.pk,
                 'hash': hash,
@@ -272,6 +293,8 @@ class WirecardMethod(BasePaymentProvider):
         return bool(self.settings.get('toolkit_password'))
 
     def _refund(self, order_number, amount, currency, language):
+        from .toolkit import post
+
         params = {
             'customerId': self.settings.get('customer_id'),
             'shopId': self.settings.get('shop_id', ''),
@@ -282,30 +305,30 @@ class WirecardMethod(BasePaymentProvider):
             'amount': str(amount),
             'currency': currency
         }
-        r = requests.post(
-            'https://checkout.wirecard.com/page/toolkit.php',
-            data=self.sign_parameters(
-                params,
-                ['customerId', 'shopId', 'toolkitPassword', 'secret', 'command', 'language', 'orderNumber', 'amount',
-                 'currency']
-            )
-        )
-        retvals = parse_qs(r.text)
+        retvals = post(self.sign_parameters(
+            params,
+            ['customerId', 'shopId', 'toolkitPassword', 'secret', 'command', 'language', 'orderNumber', 'amount',
+             'currency']
+        ))
         if retvals['status'][0] != '0':
-            logger.error('Wirecard error during refund: %s' % r.text)
-            raise PaymentException(_('Wirecard reported an error: {msg}').format(msg=retvals['message'][0]))
+            logger.error('Wirecard error during refund: %s' % retvals)
+            raise PaymentException(_('Wirecard reported an error: {msg}').format(
+                msg=retvals.get('message', [''])[0] or retvals['status'][0]
+            ))
 
     def execute_refund(self, refund: OrderRefund):
-        try:
-            self._refund(
-                refund.payment.info_data['orderNumber'], refund.amount, self.event.currency, refund.order.locale[:2]
-            )
-        except requests.exceptions.RequestException as e:
-            logger.exception('Wirecard error: %s' % str(e))
-            raise PaymentException(_('We had trouble communicating with Wirecard. Please try again and contact '
-                                     'support if the problem persists.'))
-        else:
-            refund.done()
+        from .tasks import refund_via_toolkit
+
+        if not refund.payment.info_data.get('orderNumber'):
+            raise PaymentException(_('This payment cannot be refunded automatically since Wirecard did not report '
+                                     'an order number for it.'))
+
+        # The Toolkit call happens in a background job, see tasks.refund_via_toolkit
+        refund.state = OrderRefund.REFUND_STATE_TRANSIT
+        refund.save(update_fields=['state'])
+        transaction.on_commit(lambda: refund_via_toolkit.apply_async(
+            kwargs={'event': self.event.pk, 'refund': refund.pk}
+        ))
 
     def shred_payment_info(self, obj: Union[OrderPayment, OrderRefund]):
         d = obj.info_data
@@ -333,146 +356,7 @@ class WirecardMethod(BasePaymentProvider):
             le.save(update_fields=['data', 'shredded'])
 
 
-class WirecardCC(WirecardMethod):
-    verbose_name = _('Credit card via Wirecard')
-    public_name = _('Credit card')
-    method = 'cc'
-    wc_payment_type = 'CCARD'
-    statement_length = 200
-
-
-class WirecardBancontact(WirecardMethod):
-    verbose_name = _('Bancontact via Wirecard')
-    public_name = _('Bancontact')
-    method = 'bancontact'
-    wc_payment_type = 'BANCONTACT_MISTERCASH'
-    statement_length = 25
-    order_ref_length = 10
-
-
-class WirecardEKonto(WirecardMethod):
-    verbose_name = _('eKonto via Wirecard')
-    public_name = _('eKonto')
-    method = 'ekonto'
-    wc_payment_type = 'EKONTO'
-    statement_length = 115
-    order_ref_length = 10
-
-
-class WirecardEPayBG(WirecardMethod):
-    verbose_name = _('ePay.bg via Wirecard')
-    public_name = _('ePay.bg')
-    method = 'epay_bg'
-    wc_payment_type = 'EPAY_BG'
-    statement_length = 100
-    order_ref_length = 64
-
-
-class WirecardEPS(WirecardMethod):
-    verbose_name = _('eps-Ueberweisung via Wirecard')
-    public_name = _('eps-Ueberweisung')
-    method = 'eps'
-    wc_payment_type = 'EPS'
-    statement_length = 254
-    order_ref_length = 35
-
-
-class WirecardGiropay(WirecardMethod):
-    verbose_name = _('giropay via Wirecard')
-    public_name = _('giropay')
-    method = 'giropay'
-    wc_payment_type = 'GIROPAY'
-    statement_length = 254
-    order_ref_length = 32
-
-
-class WirecardIdeal(WirecardMethod):
-    verbose_name = _('iDEAL via Wirecard')
-    public_name = _('iDEAL')
-    method = 'idl'
-    wc_payment_type = 'IDL'
-    statement_length = 35
-    order_ref_length = 32
-
-
-class WirecardMoneta(WirecardMethod):
-    verbose_name = _('moneta.ru via Wirecard')
-    public_name = _('moneta.ru')
-    method = 'moneta'
-    wc_payment_type = 'MONETA'
-    statement_length = 25
-    order_ref_length = 10
-
-
-class WirecardPrzelewy24(WirecardMethod):
-    verbose_name = _('Przelewy24 via Wirecard')
-    public_name = _('Przelewy24')
-    method = 'moneta'
-    wc_payment_type = 'MONETA'
-    statement_length = 25
-    order_ref_length = 10
-
-
-class WirecardPOLi(WirecardMethod):
-    verbose_name = _('POLi via Wirecard')
-    public_name = _('POLi')
-    method = 'poli'
-    wc_payment_type = 'POLI'
-    statement_length = 9
-    order_ref_length = 10
-
-
-class WirecardSkrill(WirecardMethod):
-    verbose_name = _('Skrill Digital Wallet via Wirecard')
-    public_name = _('Skrill Digital Wallet')
-    method = 'skrill'
-    wc_payment_type = 'SKRILLWALLET'
-    statement_length = 27
-    order_ref_length = 64
-
-
-class WirecardTatra(WirecardMethod):
-    verbose_name = _('TatraPay via Wirecard')
-    public_name = _('TatraPay')
-    method = 'tatra'
-    wc_payment_type = 'TATRAPAY'
-    statement_length = 20
-    order_ref_length = 64
-
-
-class WirecardTrustly(WirecardMethod):
-    verbose_name = _('Trustly via Wirecard')
-    public_name = _('Trustly')
-    method = 'trustly'
-    wc_payment_type = 'TRUSTLY'
-    statement_length = 225
-    order_ref_length = 10
-
-
-class WirecardTrustPay(WirecardMethod):
-    verbose_name = _('TrustPay via Wirecard')
-    public_name = _('TrustPay')
-    method = 'trustpay'
-    wc_payment_type = 'TRUSTPAY'
-
-
-class WirecardPSC(WirecardMethod):
-    verbose_name = _('paysafecard via Wirecard')
-    public_name = _('paysafecard')
-    method = 'psc'
-    wc_payment_type = 'PSC'
-    statement_length = 254
-    order_ref_length = 128
-
-
-class WirecardPayPal(WirecardMethod):
-    verbose_name = _('PayPal via Wirecard')
-    public_name = _('PayPal')
-    method = 'paypal'
-    wc_payment_type = 'PAYPAL'
-    statement_length = 254
-    order_ref_length = 128
-
+class PayPalBasketMixin:
     def params_for_payment(self, payment, request):
         params = super().params_for_payment(payment, request)
         cnt = 0
@@ -490,19 +374,45 @@ class WirecardPayPal(WirecardMethod):
         return params
 
 
-class WirecardSEPA(WirecardMethod):
-    verbose_name = _('SEPA Direct Debit via Wirecard')
-    public_name = _('SEPA Direct Debit')
-    method = 'sepadd'
-    wc_payment_type = 'SEPA-DD'
-    statement_length = 254
-    order_ref_length = 128
-
-
-class WirecardSOFORT(WirecardMethod):
-    verbose_name = _('SOFORT via Wirecard')
-    public_name = _('SOFORT')
-    method = 'sofort'
-    wc_payment_type = 'SOFORTUEBERWEISUNG'
-    statement_length = 27
-    order_ref_length = 128
+# class name, identifier suffix, Wirecard paymentType, verbose name, public name, statement length, order reference length
+METHODS = (
+    ('WirecardCC', 'cc', 'CCARD', _('Credit card via Wirecard'), _('Credit card'), 200, 32),
+    ('WirecardBancontact', 'bancontact', 'BANCONTACT_MISTERCASH', _('Bancontact via Wirecard'), _('Bancontact'), 25, 10),
+    ('WirecardEKonto', 'ekonto', 'EKONTO', _('eKonto via Wirecard'), _('eKonto'), 115, 10),
+    ('WirecardEPayBG', 'epay_bg', 'EPAY_BG', _('ePay.bg via Wirecard'), _('ePay.bg'), 100, 64),
+    ('WirecardEPS', 'eps', 'EPS', _('eps-Ueberweisung via Wirecard'), _('eps-Ueberweisung'), 254, 35),
+    ('WirecardGiropay', 'giropay', 'GIROPAY', _('giropay via Wirecard'), _('giropay'), 254, 32),
+    ('WirecardIdeal', 'idl', 'IDL', _('iDEAL via Wirecard'), _('iDEAL'), 35, 32),
+    ('WirecardMoneta', 'moneta', 'MONETA', _('moneta.ru via Wirecard'), _('moneta.ru'), 25, 10),
+    ('WirecardPayPal', 'paypal', 'PAYPAL', _('PayPal via Wirecard'), _('PayPal'), 254, 128),
+    ('WirecardPOLi', 'poli', 'POLI', _('POLi via Wirecard'), _('POLi'), 9, 10),
+    ('WirecardPrzelewy24', 'moneta', 'MONETA', _('Przelewy24 via Wirecard'), _('Przelewy24'), 25, 10),
+    ('WirecardPSC', 'psc', 'PSC', _('paysafecard via Wirecard'), _('paysafecard'), 254, 128),
+    ('WirecardSEPA', 'sepadd', 'SEPA-DD', _('SEPA Direct Debit via Wirecard'), _('SEPA Direct Debit'), 254, 128),
+    ('WirecardSkrill', 'skrill', 'SKRILLWALLET', _('Skrill Digital Wallet via Wirecard'), _('Skrill Digital Wallet'),
+     27, 64),
+    ('WirecardSOFORT', 'sofort', 'SOFORTUEBERWEISUNG', _('SOFORT via Wirecard'), _('SOFORT'), 27, 128),
+    ('WirecardTatra', 'tatra', 'TATRAPAY', _('TatraPay via Wirecard'), _('TatraPay'), 20, 64),
+    ('WirecardTrustly', 'trustly', 'TRUSTLY', _('Trustly via Wirecard'), _('Trustly'), 225, 10),
+    ('WirecardTrustPay', 'trustpay', 'TRUSTPAY', _('TrustPay via Wirecard'), _('TrustPay'), 32, 32),
+)
+
+METHOD_MIXINS = {
+    'WirecardPayPal': (PayPalBasketMixin,),
+}
+
+
+def _method_provider(name, method, wc_payment_type, verbose_name, public_name, statement_length, order_ref_length):
+    return type(name, METHOD_MIXINS.get(name, ()) + (WirecardMethod,), {
+        '__module__': __name__,
+        'method': method,
+        'wc_payment_type': wc_payment_type,
+        'verbose_name': verbose_name,
+        'public_name': public_name,
+        'statement_length': statement_length,
+        'order_ref_length': order_ref_length,
+    })
+
+
+PROVIDERS = [_method_provider(*m) for m in METHODS]
+globals().update({p.__name__: p for p in PROVIDERS})
@@ -1,38 +1,51 @@
 import json
 
+from django.core.cache import cache
 from django.dispatch import receiver
 from django.http import HttpRequest, HttpResponse
 from django.template.loader import get_template
 from django.urls import resolve
 from django.utils.translation import ugettext_lazy as _
 
-from pretix.base.middleware import _parse_csp, _merge_csp, _render_csp
-from pretix.base.signals import register_payment_providers, logentry_display, requiredaction_display
+from pretix.base.signals import register_payment_providers, logentry_display, requiredaction_display, \
+    register_data_exporters, periodic_task
 from pretix.presale.signals import process_response
-from .payment import WirecardSettingsHolder, WirecardCC, WirecardBancontact, WirecardEKonto, WirecardEPayBG, \
-    WirecardEPS, WirecardGiropay, WirecardIdeal, WirecardMoneta, WirecardPayPal, WirecardPOLi, WirecardPrzelewy24, \
-    WirecardPSC, WirecardSEPA, WirecardSkrill, WirecardSOFORT, WirecardTatra, WirecardTrustly, WirecardTrustPay
+
+SWEEP_INTERVAL = 3600
 
 
 @receiver(register_payment_providers, dispatch_uid="payment_wirecard")
 def register_payment_provider(sender, **kwargs):
-    return [WirecardSettingsHolder, WirecardCC, WirecardBancontact, WirecardEKonto, WirecardEPayBG, WirecardEPS,
-            WirecardGiropay, WirecardIdeal, WirecardMoneta, WirecardPayPal, WirecardPOLi, WirecardPrzelewy24,
-            WirecardPSC, WirecardSEPA, WirecardSkrill, WirecardSOFORT, WirecardTatra, WirecardTrustly, WirecardTrustPay]
+    from .payment import WirecardSettingsHolder, PROVIDERS
+
+    return [WirecardSettingsHolder] + PROVIDERS
+
+
+@receiver(register_data_exporters, dispatch_uid="exporter_wirecard")
+def register_data_exporter(sender, **kwargs):
+    from .exporters import WirecardTransactionExporter
+    return WirecardTransactionExporter
 
 
 @receiver(signal=process_response, dispatch_uid="wirecard_middleware_resp")
 def signal_process_response(sender, request: HttpRequest, response: HttpResponse, **kwargs):
-    provider = WirecardSettingsHolder(sender)
     url = resolve(request.path_info)
-    if provider.settings.get('_enabled', as_type=bool) and ("checkout" in url.url_name or "order.pay" in url.url_name):
+    if not ("checkout" in url.url_name or "order.pay" in url.url_name):
+        return response
+
+    from pretix.base.middleware import _parse_csp, _merge_csp, _render_csp
+    from .conf import init_host
+    from .payment import WirecardSettingsHolder
+
+    provider = WirecardSettingsHolder(sender)
+    if provider.settings.get('_enabled', as_type=bool):
         if 'Content-Security-Policy' in response:
             h = _parse_csp(response['Content-Security-Policy'])
         else:
             h = {}
 
         _merge_csp(h, {
-            'form-action': ['checkout.wirecard.com'],
+            'form-action': [init_host()],
         })
 
         if h:
@@ -42,6 +55,20 @@ def signal_process_response(sender, request: HttpRequest, response: HttpResponse
 
 @receiver(signal=logentry_display, dispatch_uid="wirecard_logentry_display")
 def pretixcontrol_logentry_display(sender, logentry, **kwargs):
+    if logentry.action_type == 'pretix_wirecard.wirecard.refund_failed':
+        data = json.loads(logentry.data)
+        return _('The Wirecard refund {local_id} failed: {message}').format(**data)
+
+    if logentry.action_type == 'pretix_wirecard.wirecard.payment_swept':
+        data = json.loads(logentry.data)
+        return _('The Wirecard payment {local_id} has been marked as {new_state} since we did not hear from Wirecard '
+                 'in time.').format(**data)
+
+    if logentry.action_type == 'pretix_wirecard.wirecard.late_success':
+        data = json.loads(logentry.data)
+        return _('Wirecard reported a successful charge for the payment {local_id}, which had already been canceled '
+                 'or marked as failed.').format(**data)
+
     if logentry.action_type != 'pretix_wirecard.wirecard.event':
         return
 
@@ -65,6 +92,22 @@ def pretixcontrol_action_display(sender, action, request, **kwargs):
 
     if action.action_type == 'pretix_wirecard.wirecard.overpaid':
         template = get_template('pretix_wirecard/action_overpaid.html')
+    elif action.action_type == 'pretix_wirecard.wirecard.late_success':
+        template = get_template('pretix_wirecard/action_late_success.html')
+    else:
+        return
 
     ctx = {'data': data, 'event': sender, 'action': action}
     return template.render(ctx, request)
+
+
+@receiver(signal=periodic_task, dispatch_uid="wirecard_periodic_sweep")
+def periodic_sweep(sender, **kwargs):
+    # periodic_task fires every few minutes, but stale payments do not need to be found that quickly
+    if not cache.add('pretix_wirecard_periodic_sweep', True, SWEEP_INTERVAL):
+        return
+
+    from .conf import sweep_created_after, sweep_pending_after
+    from .sweeper import sweep_stale_payments
+
+    sweep_stale_payments(sweep_created_after(), sweep_pending_after())
@@ -0,0 +1,115 @@
+import json
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from pretix.base.models import LogEntry, Order, OrderPayment
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def _wirecard_state(info) -> str:
+    try:
+        return json.loads(info).get('paymentState', '') if info else ''
+    except (ValueError, AttributeError):
+        return ''
+
+
+def _abandoned_state(state: str, info):
+    # The customer left Wirecard without paying: either Wirecard never called us, or it reported CANCEL or FAILURE.
+    # process_result only changes the state of the payment on SUCCESS, so all of these are still created.
+    if state == OrderPayment.PAYMENT_STATE_CREATED and _wirecard_state(info) not in ('PENDING', 'SUCCESS'):
+        return OrderPayment.PAYMENT_STATE_CANCELED
+
+
+def _pending_state(state: str, info):
+    # The plugin keeps payments that Wirecard reports as PENDING in the created state, see process_result
+    if state == OrderPayment.PAYMENT_STATE_PENDING or (
+        state == OrderPayment.PAYMENT_STATE_CREATED and _wirecard_state(info) == 'PENDING'
+    ):
+        return OrderPayment.PAYMENT_STATE_FAILED
+    # Payments that only got canceled at Wirecard after the abandoned sweep passed them by
+    return _abandoned_state(state, info)
+
+
+# Filter for candidates and a function that returns the new state of a candidate, or None to leave it untouched
+SWEEPS = {
+    'abandoned': (Q(state=OrderPayment.PAYMENT_STATE_CREATED), _abandoned_state),
+    'pending': (Q(state__in=(OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING)), _pending_state),
+}
+
+
+def _sweep(name: str, cutoff, dry_run: bool, resume: bool) -> Counter:
+    q, new_state_for = SWEEPS[name]
+    result = Counter()
+    order_type = ContentType.objects.get_for_model(Order)
+    # Payments are created in primary key order, so everything up to the last payment we looked at in the previous
+    # run was already old enough back then and has been dealt with. This keeps the steady-state walk short.
+    progress_key = 'pretix_wirecard_sweep_{}_pk'.format(name)
+    last_pk = (cache.get(progress_key) or 0) if resume else 0
+    while True:
+        # Walking the primary key index in fixed-size batches keeps every query and transaction short, no matter
+        # how many stale payments have piled up.
+        batch = list(
+            OrderPayment.objects.filter(
+                q, pk__gt=last_pk, provider__startswith='wirecard', created__lt=cutoff
+            ).order_by('pk').values_list('pk', 'order_id', 'order__event_id', 'local_id', 'state', 'info')[:BATCH_SIZE]
+        )
+        if not batch:
+            return result
+        last_pk = batch[-1][0]
+
+        if dry_run:
+            result.update(
+                event_id for pk, order_id, event_id, local_id, state, info in batch if new_state_for(state, info)
+            )
+            continue
+
+        with transaction.atomic():
+            # Lock the rows and check them again, so payments Wirecard reported on in the meantime stay untouched
+            current = OrderPayment.objects.select_for_update().filter(
+                pk__in=[row[0] for row in batch]
+            ).values_list('pk', 'state', 'info')
+            changes = {}
+            for pk, state, info in current:
+                new_state = new_state_for(state, info)
+                if new_state:
+                    changes[pk] = (state, new_state)
+            for new_state in set(n for o, n in changes.values()):
+                OrderPayment.objects.filter(
+                    pk__in=[pk for pk, (o, n) in changes.items() if n == new_state]
+                ).update(state=new_state)
+            LogEntry.objects.bulk_create([
+                LogEntry(
+                    content_type=order_type, object_id=order_id, event_id=event_id,
+                    action_type='pretix_wirecard.wirecard.payment_swept',
+                    data=json.dumps({'local_id': local_id, 'old_state': changes[pk][0], 'new_state': changes[pk][1]}),
+                )
+                for pk, order_id, event_id, local_id, state, info in batch if pk in changes
+            ])
+        cache.set(progress_key, last_pk, None)
+        result.update(event_id for pk, order_id, event_id, local_id, state, info in batch if pk in changes)
+
+
+def sweep_stale_payments(created_after: int, pending_after: int, dry_run=False, resume=True) -> dict:
+    """
+    Cancels Wirecard payments the customer abandoned without paying and marks payments that stayed pending at
+    Wirecard for too long as failed. Ages are given in hours. With ``resume``, payments already looked at in a
+    previous run are skipped. Returns the number of affected payments per sweep and event ID.
+    """
+    report = {
+        'abandoned': _sweep('abandoned', now() - timedelta(hours=created_after), dry_run, resume),
+        'pending': _sweep('pending', now() - timedelta(hours=pending_after), dry_run, resume),
+    }
+    if not dry_run:
+        logger.info('Swept stale Wirecard payments: %d abandoned, %d pending',
+                    sum(report['abandoned'].values()), sum(report['pending'].values()))
+    return report
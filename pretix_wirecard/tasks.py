@@ -0,0 +1,52 @@
+import logging
+
+from django.utils.translation import ugettext_lazy as _
+
+from pretix.base.models import Event, OrderRefund
+from pretix.base.payment import PaymentException
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+logger = logging.getLogger(__name__)
+
+REFUND_MAX_RETRIES = 8
+REFUND_RETRY_BASE_DELAY = 30
+
+
+@app.task(base=EventTask, bind=True, max_retries=REFUND_MAX_RETRIES)
+def refund_via_toolkit(self, event: Event, refund: int):
+    from .toolkit import ToolkitConnectionError, ToolkitUnavailable
+
+    refund = OrderRefund.objects.select_related('order', 'payment').get(order__event=event, pk=refund)
+    if refund.state != OrderRefund.REFUND_STATE_TRANSIT:
+        return
+
+    prov = refund.payment_provider
+    try:
+        prov._refund(
+            refund.payment.info_data['orderNumber'], refund.amount, event.currency, refund.order.locale[:2]
+        )
+    except ToolkitConnectionError as e:
+        logger.warning('Wirecard error during refund %s (attempt %d): %s', refund.pk, self.request.retries + 1, e)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=REFUND_RETRY_BASE_DELAY * 2 ** self.request.retries)
+        _fail(refund, e if isinstance(e, ToolkitUnavailable) else _('We had trouble communicating with Wirecard.'))
+    except PaymentException as e:
+        _fail(refund, e)
+    except Exception:
+        # Never leave the refund in transit, somebody needs to look at it
+        logger.exception('Unexpected error during Wirecard refund %s', refund.pk)
+        _fail(refund, _('An unexpected error occurred. Please check the transaction in the Wirecard backend.'))
+    else:
+        refund.done()
+
+
+def _fail(refund: OrderRefund, message):
+    message = str(message)
+    refund.state = OrderRefund.REFUND_STATE_FAILED
+    refund.info_data = dict(refund.info_data, error=message)
+    refund.save(update_fields=['state', 'info'])
+    refund.order.log_action('pretix_wirecard.wirecard.refund_failed', data={
+        'local_id': refund.local_id,
+        'message': message,
+    })
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import time
+from urllib.parse import parse_qs
+
+import requests
+from django.core.cache import cache
+from django.utils.translation import ugettext_lazy as _
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from pretix.base.payment import PaymentException
+from .conf import toolkit_url
+
+logger = logging.getLogger(__name__)
+
+TOOLKIT_TIMEOUT = 20
+
+# Number of consecutive failures (or slow responses) after which we stop talking to an endpoint
+FAILURE_THRESHOLD = 5
+# Responses slower than this (in seconds) count as failures even if they were successful
+SLOW_CALL_THRESHOLD = 10
+# Time (in seconds) an open circuit waits before letting a single probe request through
+RESET_TIMEOUT = 60
+
+
+class ToolkitConnectionError(Exception):
+    pass
+
+
+class ToolkitUnavailable(ToolkitConnectionError, PaymentException):
+    def __init__(self):
+        super().__init__(_('Wirecard is currently not reachable. Please try again in a few minutes.'))
+
+
+class ToolkitUncertainError(PaymentException):
+    """
+    The request might have reached Wirecard and been executed, so it must not be sent again blindly.
+    """
+
+    def __init__(self):
+        super().__init__(_('We could not find out whether Wirecard has processed this request. Please check the '
+                           'transaction in the Wirecard backend before trying again.'))
+
+
+def _request_not_sent(e: requests.exceptions.RequestException) -> bool:
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        # A connection error may also mean the connection dropped after the request was sent. Only a failure to
+        # establish the connection at all guarantees that Wirecard never saw the request.
+        reason = e.args[0] if e.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class CircuitBreaker:
+    """
+    Keeps track of failing calls to an endpoint in the cache backend, so that all worker processes share the same
+    view of whether the endpoint is healthy.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.prefix = 'pretix_wirecard_circuit_{}'.format(hashlib.sha1(endpoint.encode()).hexdigest())
+
+    def _key(self, name):
+        return '{}_{}'.format(self.prefix, name)
+
+    def before_call(self) -> bool:
+        """
+        Raises ``ToolkitUnavailable`` if the circuit is open. Returns ``True`` if the call is a half-open probe.
+        """
+        opened = cache.get(self._key('opened'))
+        if opened is None:
+            return False
+        if time.time() - opened < RESET_TIMEOUT:
+            raise ToolkitUnavailable()
+        # Only one process gets to probe, everybody else keeps failing fast until the probe is done
+        if not cache.add(self._key('probe'), True, TOOLKIT_TIMEOUT * 2):
+            raise ToolkitUnavailable()
+        return True
+
+    def record_success(self, latency: float, probe: bool):
+        cache.set(self._key('latency'), latency, None)
+        if latency > SLOW_CALL_THRESHOLD:
+            self.record_failure(latency, probe)
+            return
+        cache.delete_many([self._key('failures'), self._key('opened'), self._key('probe')])
+
+    def record_failure(self, latency: float, probe: bool):
+        cache.set(self._key('latency'), latency, None)
+        try:
+            failures = cache.incr(self._key('failures'))
+        except ValueError:
+            cache.add(self._key('failures'), 1, None)
+            failures = 1
+        if probe or failures >= FAILURE_THRESHOLD:
+            cache.set(self._key('opened'), time.time(), None)
+            cache.delete(self._key('probe'))
+
+    def status(self) -> dict:
+        values = cache.get_many([self._key(k) for k in ('failures', 'opened', 'probe', 'latency')])
+        opened = values.get(self._key('opened'))
+        if opened is None:
+            state = 'closed'
+        elif values.get(self._key('probe')) or time.time() - opened >= RESET_TIMEOUT:
+            state = 'half-open'
+        else:
+            state = 'open'
+        return {
+            'endpoint': self.endpoint,
+            'state': state,
+            'failures': values.get(self._key('failures'), 0),
+            'opened_at': opened,
+            'last_latency': values.get(self._key('latency')),
+        }
+
+
+def post(data: dict) -> dict:
+    url = toolkit_url()
+    breaker = CircuitBreaker(url)
+    probe = breaker.before_call()
+    start = time.time()
+    try:
+        r = requests.post(url, data=data, timeout=TOOLKIT_TIMEOUT)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        breaker.record_failure(time.time() - start, probe)
+        if _request_not_sent(e):
+            raise ToolkitConnectionError(str(e)) from e
+        logger.exception('Wirecard Toolkit request to %s might have been delivered', url)
+        raise ToolkitUncertainError() from e
+
+    retvals = parse_qs(r.text)
+    if 'status' not in retvals:
+        breaker.record_failure(time.time() - start, probe)
+        logger.error('Unexpected response from Wirecard Toolkit at %s: %s', url, r.text)
+        raise ToolkitUncertainError()
+    breaker.record_success(time.time() - start, probe)
+    return retvals
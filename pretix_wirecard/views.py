@@ -1,5 +1,6 @@
 import hashlib
 import hmac
+import json
 import logging
 
 from django.contrib import messages
@@ -14,8 +15,9 @@ from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView
 
-from pretix.base.models import Order, Quota, OrderPayment
+from pretix.base.models import Order, Quota, OrderPayment, RequiredAction
 from pretix.multidomain.urlreverse import eventreverse
+from .conf import init_url
 
 logger = logging.getLogger('pretix_wirecard')
 
@@ -38,7 +40,7 @@ class WirecardOrderView:
     def pprov(self):
         return self.payment.payment_provider
 
-    @property
+    @cached_property
     def payment(self):
         return get_object_or_404(
             self.order.payments,
@@ -53,7 +55,8 @@ class RedirectView(WirecardOrderView, TemplateView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx['params'] = self.pprov.sign_parameters(self.pprov.params_for_payment(self.payment, self.request))
+        ctx['params'] = self.pprov.signed_params_for_payment(self.payment, self.request)
+        ctx['init_url'] = init_url()
         return ctx
 
 
@@ -76,12 +79,26 @@ def validate_fingerprint(request, prov):
 
 
 def process_result(request, payment, prov):
+    previous_state = payment.info_data.get('paymentState')
     payment.info_data = dict(request.POST.items())
     payment.save()
     if payment.state in (
             OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED
     ) and request.POST.get('paymentState') == 'SUCCESS':
         payment.confirm()
+    elif payment.state in (
+            OrderPayment.PAYMENT_STATE_CANCELED, OrderPayment.PAYMENT_STATE_FAILED
+    ) and request.POST.get('paymentState') == 'SUCCESS' and previous_state != 'SUCCESS':
+        # Most likely the payment was swept as stale before Wirecard got back to us. The customer has paid,
+        # so somebody needs to take care of the order manually. Wirecard may repeat its confirmation, but we
+        # only need to raise this once.
+        logger.warning('Wirecard reported success for %s payment %s', payment.state, payment.full_id)
+        payment.order.log_action('pretix_wirecard.wirecard.late_success', data={'local_id': payment.local_id})
+        RequiredAction.objects.create(
+            event=payment.order.event, action_type='pretix_wirecard.wirecard.late_success',
+            data=json.dumps({'order': payment.order.code, 'payment': payment.local_id,
+                             'orderNumber': request.POST.get('orderNumber')})
+        )
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -0,0 +1,30 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+
+from pretix.base.models import Event, Order, Organizer
+
+
+@pytest.fixture
+def event():
+    cache.clear()
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy', date_from=now(), plugins='pretix_wirecard'
+    )
+    event.settings.set('payment_wirecard__enabled', True)
+    event.settings.set('payment_wirecard_customer_id', 'D200001')
+    event.settings.set('payment_wirecard_secret', 'B8AKTPWBRMNBV455FG6M2DANE99WU2')
+    event.settings.set('payment_wirecard_toolkit_password', 'jcv45z')
+    return event
+
+
+@pytest.fixture
+def order(event):
+    return Order.objects.create(
+        code='FOO', event=event, email='dummy@dummy.test', status=Order.STATUS_PENDING, locale='en',
+        datetime=now(), expires=now() + timedelta(days=10), total=Decimal('13.00'),
+    )
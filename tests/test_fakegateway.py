@@ -0,0 +1,112 @@
+from unittest import mock
+
+from pretix_wirecard.fakegateway import REFUND_ORDER, Gateway, RateLimiter, fingerprint
+from pretix_wirecard.payment import WirecardMethod
+from pretix_wirecard.views import validate_fingerprint
+
+SECRET = 'B8AKTPWBRMNBV455FG6M2DANE99WU2'
+
+
+class Provider:
+    sign_parameters = WirecardMethod.sign_parameters
+
+    def __init__(self):
+        self.settings = {'secret': SECRET}
+
+
+class Request:
+    def __init__(self, data):
+        self.POST = data
+
+
+def _init_params():
+    return Provider().sign_parameters({
+        'customerId': 'D200001',
+        'amount': '13.00',
+        'currency': 'EUR',
+        'paymentType': 'SELECT',
+        'language': 'en',
+        'successUrl': 'https://pretix.test/return/',
+        'cancelUrl': 'https://pretix.test/return/',
+        'failureUrl': 'https://pretix.test/return/',
+        'pendingUrl': 'https://pretix.test/return/pending/',
+        'confirmUrl': 'https://pretix.test/confirm/',
+        'duplicateRequestCheck': 'yes',
+        'orderReference': 'FOOabc',
+        'pretix_orderCode': 'FOO',
+    })
+
+
+def _gateway(scenario='SUCCESS'):
+    return Gateway(SECRET, 'jcv45z', {scenario: 1}, 0, 0, 0)
+
+
+def test_accepts_plugin_signature():
+    assert _gateway().verify_request(_init_params())
+
+
+def test_rejects_wrong_signature():
+    params = _init_params()
+    params['amount'] = '1.00'
+    assert not _gateway().verify_request(params)
+
+
+def test_rejects_duplicate_request():
+    g = _gateway()
+    assert g.init(_init_params()) is not None
+    assert g.init(_init_params()) is None
+
+
+def test_plugin_accepts_signed_response():
+    url, res = _gateway().init(_init_params())
+    assert url == 'https://pretix.test/return/'
+    assert res['paymentState'] == 'SUCCESS'
+    assert res['pretix_orderCode'] == 'FOO'
+    assert validate_fingerprint(Request(res), Provider())
+    res['amount'] = '1.00'
+    assert not validate_fingerprint(Request(res), Provider())
+
+
+def test_pending_flow():
+    g = _gateway('PENDING')
+    url, res = g.init(_init_params())
+    assert url == 'https://pretix.test/return/pending/'
+    assert res['paymentState'] == 'PENDING'
+    first, later = g.callbacks.get_nowait(), g.callbacks.get_nowait()
+    assert first[1] == later[1] == 'https://pretix.test/confirm/'
+    assert first[2]['paymentState'] == 'PENDING'
+    assert later[2]['paymentState'] == 'SUCCESS'
+    assert validate_fingerprint(Request(later[2]), Provider())
+
+
+def test_duplicate_flow():
+    g = _gateway('DUPLICATE')
+    g.init(_init_params())
+    assert g.snapshot()['backlog'] == 2
+
+
+def test_refund_signature():
+    params = Provider().sign_parameters({
+        'customerId': 'D200001', 'shopId': '', 'toolkitPassword': 'jcv45z', 'command': 'refund', 'language': 'en',
+        'orderNumber': '5472851', 'amount': '13.00', 'currency': 'EUR',
+    }, REFUND_ORDER)
+    assert params['requestFingerprint'] == fingerprint(SECRET, params, REFUND_ORDER)
+    assert _gateway().refund(params)['status'] == '0'
+    params['toolkitPassword'] = 'wrong'
+    assert _gateway().refund(params)['status'] == '1'
+
+
+def test_rate_limiter_spaces_slots():
+    limiter = RateLimiter(10)
+    with mock.patch('pretix_wirecard.fakegateway.time') as t:
+        t.monotonic.return_value = limiter.next_slot
+        limiter.wait()
+        limiter.wait()
+        limiter.wait()
+    assert [round(c[0][0], 3) for c in t.sleep.call_args_list] == [0.1, 0.2]
+
+
+def test_rate_limiter_unlimited():
+    with mock.patch('pretix_wirecard.fakegateway.time') as t:
+        RateLimiter(0).wait()
+    assert not t.sleep.called
@@ -0,0 +1,134 @@
+import json
+from datetime import timedelta
+
+import pytest
+from django.test import RequestFactory, override_settings
+from django.utils.timezone import now
+
+from pretix.base.models import Order, OrderPayment, RequiredAction
+from pretix_wirecard.sweeper import sweep_stale_payments
+from pretix_wirecard.views import process_result
+
+
+def _payment(order, age, state=OrderPayment.PAYMENT_STATE_CREATED, info=None):
+    p = order.payments.create(provider='wirecard_cc', amount=order.total, state=state)
+    if info is not None:
+        p.info_data = info
+        p.save()
+    OrderPayment.objects.filter(pk=p.pk).update(created=now() - age)
+    return p
+
+
+@pytest.mark.django_db
+def test_abandoned_payment_is_canceled(order):
+    p = _payment(order, timedelta(hours=25))
+    young = _payment(order, timedelta(hours=1))
+    report = sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+    young.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CANCELED
+    assert young.state == OrderPayment.PAYMENT_STATE_CREATED
+    assert report['abandoned'][order.event_id] == 1
+    assert order.all_logentries().filter(action_type='pretix_wirecard.wirecard.payment_swept').count() == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('wirecard_state', ['CANCEL', 'FAILURE'])
+def test_canceled_or_failed_at_wirecard_is_canceled(order, wirecard_state):
+    p = _payment(order, timedelta(hours=25), info={'paymentState': wirecard_state})
+    young = _payment(order, timedelta(hours=1), info={'paymentState': wirecard_state})
+    report = sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+    young.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CANCELED
+    assert young.state == OrderPayment.PAYMENT_STATE_CREATED
+    assert report['abandoned'][order.event_id] == 1
+
+
+@pytest.mark.django_db
+def test_success_at_wirecard_is_left_alone(order):
+    p = _payment(order, timedelta(days=31), info={'paymentState': 'SUCCESS'})
+    sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CREATED
+
+
+@pytest.mark.django_db
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+def test_canceled_after_abandoned_sweep_passed_is_canceled(order):
+    p = _payment(order, timedelta(days=2), info={'paymentState': 'PENDING'})
+    sweep_stale_payments(24, 24 * 30)
+    p.info_data = {'paymentState': 'CANCEL'}
+    p.save()
+    OrderPayment.objects.filter(pk=p.pk).update(created=now() - timedelta(days=31))
+    report = sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CANCELED
+    assert report['pending'][order.event_id] == 1
+
+
+@pytest.mark.django_db
+def test_wirecard_pending_payment_uses_pending_threshold(order):
+    p = _payment(order, timedelta(days=2), info={'paymentState': 'PENDING'})
+    sweep_stale_payments(24, 24 * 30, resume=False)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CREATED
+
+    OrderPayment.objects.filter(pk=p.pk).update(created=now() - timedelta(days=31))
+    report = sweep_stale_payments(24, 24 * 30, resume=False)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert report['pending'][order.event_id] == 1
+    assert sum(report['abandoned'].values()) == 0
+
+
+@pytest.mark.django_db
+def test_pretix_pending_payment_is_failed(order):
+    p = _payment(order, timedelta(days=31), state=OrderPayment.PAYMENT_STATE_PENDING)
+    sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_FAILED
+
+
+@pytest.mark.django_db
+def test_dry_run_changes_nothing(order):
+    p = _payment(order, timedelta(hours=25))
+    report = sweep_stale_payments(24, 24 * 30, dry_run=True)
+    p.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CREATED
+    assert report['abandoned'][order.event_id] == 1
+    assert not order.all_logentries().filter(action_type='pretix_wirecard.wirecard.payment_swept').exists()
+
+
+@pytest.mark.django_db
+def test_success_for_swept_payment_is_flagged(order):
+    p = _payment(order, timedelta(hours=25))
+    sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+
+    request = RequestFactory().post('/', {'paymentState': 'SUCCESS', 'orderNumber': '12345'})
+    process_result(request, p, p.payment_provider)
+
+    p.refresh_from_db()
+    order.refresh_from_db()
+    assert p.state == OrderPayment.PAYMENT_STATE_CANCELED
+    assert order.status == Order.STATUS_PENDING
+    assert order.all_logentries().filter(action_type='pretix_wirecard.wirecard.late_success').exists()
+    action = RequiredAction.objects.get(event=order.event, action_type='pretix_wirecard.wirecard.late_success')
+    assert json.loads(action.data) == {'order': 'FOO', 'payment': p.local_id, 'orderNumber': '12345'}
+
+
+@pytest.mark.django_db
+def test_repeated_success_for_swept_payment_is_flagged_once(order):
+    p = _payment(order, timedelta(hours=25))
+    sweep_stale_payments(24, 24 * 30)
+    p.refresh_from_db()
+
+    for i in range(2):
+        request = RequestFactory().post('/', {'paymentState': 'SUCCESS', 'orderNumber': '12345'})
+        process_result(request, p, p.payment_provider)
+
+    assert order.all_logentries().filter(action_type='pretix_wirecard.wirecard.late_success').count() == 1
+    assert RequiredAction.objects.filter(
+        event=order.event, action_type='pretix_wirecard.wirecard.late_success'
+    ).count() == 1
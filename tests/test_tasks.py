@@ -0,0 +1,100 @@
+from unittest import mock
+
+import pytest
+from celery.exceptions import Retry
+
+from pretix.base.models import OrderPayment, OrderRefund
+from pretix_wirecard import toolkit
+from pretix_wirecard.tasks import REFUND_MAX_RETRIES, REFUND_RETRY_BASE_DELAY, refund_via_toolkit
+
+
+@pytest.fixture
+def refund(order):
+    p = order.payments.create(
+        provider='wirecard_cc', amount=order.total, state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+        info='{"orderNumber": "5472851", "paymentState": "SUCCESS"}'
+    )
+    return order.refunds.create(
+        payment=p, provider='wirecard_cc', amount=order.total, state=OrderRefund.REFUND_STATE_TRANSIT,
+        source=OrderRefund.REFUND_SOURCE_ADMIN
+    )
+
+
+def _run(refund):
+    return refund_via_toolkit.apply(kwargs={'event': refund.order.event.pk, 'refund': refund.pk})
+
+
+@pytest.mark.django_db
+def test_success(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', return_value={'status': ['0']}) as post:
+        _run(refund)
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
+    data = post.call_args[0][0]
+    assert data['command'] == 'refund'
+    assert data['orderNumber'] == '5472851'
+    assert data['amount'] == '13.00'
+
+
+@pytest.mark.django_db
+def test_connect_failure_is_retried_with_backoff(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', side_effect=toolkit.ToolkitConnectionError('refused')), \
+            mock.patch.object(refund_via_toolkit, 'retry', side_effect=Retry()) as retry:
+        _run(refund)
+    assert retry.call_args[1]['countdown'] == REFUND_RETRY_BASE_DELAY
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_TRANSIT
+
+
+@pytest.mark.django_db
+def test_connect_failure_recovers(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', side_effect=[
+        toolkit.ToolkitConnectionError('refused'), {'status': ['0']}
+    ]) as post:
+        _run(refund)
+    assert post.call_count == 2
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
+
+
+@pytest.mark.django_db
+def test_connect_failure_gives_up(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', side_effect=toolkit.ToolkitConnectionError('refused')) as post:
+        _run(refund)
+    assert post.call_count == REFUND_MAX_RETRIES + 1
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+
+
+@pytest.mark.django_db
+def test_uncertain_error_is_not_retried(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', side_effect=toolkit.ToolkitUncertainError()) as post:
+        _run(refund)
+    assert post.call_count == 1
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert 'Wirecard backend' in refund.info_data['error']
+    assert refund.order.all_logentries().filter(action_type='pretix_wirecard.wirecard.refund_failed').exists()
+
+
+@pytest.mark.django_db
+def test_rejection_fails(refund):
+    with mock.patch('pretix_wirecard.toolkit.post', return_value={
+        'status': ['1'], 'message': ['Refund amount exceeds limit.']
+    }) as post:
+        _run(refund)
+    assert post.call_count == 1
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert 'Refund amount exceeds limit.' in refund.info_data['error']
+
+
+@pytest.mark.django_db
+def test_refund_not_in_transit_is_skipped(refund):
+    refund.state = OrderRefund.REFUND_STATE_CANCELED
+    refund.save()
+    with mock.patch('pretix_wirecard.toolkit.post') as post:
+        _run(refund)
+    assert not post.called
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_CANCELED
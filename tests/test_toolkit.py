@@ -0,0 +1,93 @@
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.test import override_settings
+
+from pretix_wirecard.toolkit import (
+    FAILURE_THRESHOLD, RESET_TIMEOUT, SLOW_CALL_THRESHOLD, CircuitBreaker, ToolkitUnavailable,
+)
+
+
+@pytest.fixture
+def clock():
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        cache.clear()
+        with mock.patch('pretix_wirecard.toolkit.time') as t:
+            t.time.return_value = 1000000.0
+            yield t
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker('https://checkout.wirecard.test/page/toolkit.php')
+
+
+def _open(breaker):
+    for i in range(FAILURE_THRESHOLD):
+        assert not breaker.before_call()
+        breaker.record_failure(1, False)
+
+
+def test_opens_after_threshold(breaker):
+    for i in range(FAILURE_THRESHOLD - 1):
+        breaker.record_failure(1, False)
+    assert breaker.status()['state'] == 'closed'
+    assert not breaker.before_call()
+    breaker.record_failure(1, False)
+    assert breaker.status()['state'] == 'open'
+    assert breaker.status()['failures'] == FAILURE_THRESHOLD
+
+
+def test_success_resets_failures(breaker):
+    for i in range(FAILURE_THRESHOLD - 1):
+        breaker.record_failure(1, False)
+    breaker.record_success(1, False)
+    breaker.record_failure(1, False)
+    assert breaker.status()['state'] == 'closed'
+
+
+def test_fails_fast_while_open(breaker, clock):
+    _open(breaker)
+    clock.time.return_value += RESET_TIMEOUT - 1
+    with pytest.raises(ToolkitUnavailable):
+        breaker.before_call()
+
+
+def test_single_probe(breaker, clock):
+    _open(breaker)
+    clock.time.return_value += RESET_TIMEOUT
+    assert breaker.before_call() is True
+    assert breaker.status()['state'] == 'half-open'
+    with pytest.raises(ToolkitUnavailable):
+        breaker.before_call()
+
+
+def test_successful_probe_closes(breaker, clock):
+    _open(breaker)
+    clock.time.return_value += RESET_TIMEOUT
+    probe = breaker.before_call()
+    breaker.record_success(1, probe)
+    assert breaker.status()['state'] == 'closed'
+    assert not breaker.before_call()
+
+
+def test_failed_probe_reopens(breaker, clock):
+    _open(breaker)
+    clock.time.return_value += RESET_TIMEOUT
+    probe = breaker.before_call()
+    breaker.record_failure(1, probe)
+    assert breaker.status()['state'] == 'open'
+    with pytest.raises(ToolkitUnavailable):
+        breaker.before_call()
+    clock.time.return_value += RESET_TIMEOUT
+    assert breaker.before_call() is True
+
+
+def test_slow_call_counts_as_failure(breaker):
+    breaker.record_success(SLOW_CALL_THRESHOLD + 1, False)
+    assert breaker.status()['failures'] == 1
+    assert breaker.status()['last_latency'] == SLOW_CALL_THRESHOLD + 1
+    for i in range(FAILURE_THRESHOLD - 1):
+        breaker.record_success(SLOW_CALL_THRESHOLD + 1, False)
+    assert breaker.status()['state'] == 'open'